@@ -1,7 +1,8 @@
 """ This module uses the difficulty scorer registry to get a difficulty scorer"""
 
+from typing import Any, Dict, Optional, Tuple
+
 from transformers import PreTrainedTokenizerFast, Trainer
-from typing_extensions import Protocol, runtime_checkable
 
 # typing imports
 from src.config import DifficultyScorerKwargsType
@@ -14,14 +15,58 @@ from .perplexity import NGramPerplexityScorer
 from .registry import DIFFICULTY_SCORER_REGISTRY
 
 
-@runtime_checkable
-class UsesTokenizer(Protocol):
-    tokenizer: PreTrainedTokenizerFast
+# Names of the difficulty scorers that need access to the trainer or to the tokenizer; these
+# are precomputed from the registry so that no reflection is needed when scorers are created.
+# NOTE: The scorers expose the trainer and the tokenizer as properties, so we can check for
+# them on the class itself
+_USES_TRAINER = {
+    name
+    for name, cls in DIFFICULTY_SCORER_REGISTRY.items()
+    if hasattr(cls, "trainer")
+}
+
+_USES_TOKENIZER = {
+    name
+    for name, cls in DIFFICULTY_SCORER_REGISTRY.items()
+    if hasattr(cls, "tokenizer")
+}
 
+DifficultyScorerCacheKey = Tuple[str, str, Tuple[Tuple[str, Any], ...]]
 
-@runtime_checkable
-class UsesTrainer(Protocol):
-    trainer: Trainer
+# Difficulty scorers that have already been initialized, keyed by their name, the dataset they
+# score and their kwargs. Some scorers are expensive to initialize (or to score the dataset
+# with, and store the scores they have computed), so repeated requests for the same
+# configuration on the same dataset reuse the same scorer.
+_DIFFICULTY_SCORER_CACHE: Dict[
+    DifficultyScorerCacheKey, BaseDifficultyScorer
+] = {}
+
+
+def _get_difficulty_scorer_cache_key(
+    difficulty_scorer_name: str,
+    difficulty_scorer_kwargs: DifficultyScorerKwargsType,
+    trainer: Trainer,
+) -> Optional[DifficultyScorerCacheKey]:
+    """
+    Returns a hashable key for the difficulty scorer cache, or None if the scorer should not be
+    cached because the train dataset has no fingerprint to identify it by. Kwarg values that
+    are not hashable (e.g. lists) are represented by their (tagged) repr.
+    """
+
+    dataset_fingerprint = getattr(trainer.train_dataset, "_fingerprint", None)
+    if dataset_fingerprint is None:
+        return None
+
+    kwargs_items = []
+    for key, value in sorted((difficulty_scorer_kwargs or {}).items()):
+        try:
+            hash(value)
+        except TypeError:
+            # NOTE: tagging the repr so that it can't collide with a string kwarg value
+            value = ("__repr__", repr(value))
+        kwargs_items.append((key, value))
+
+    return (difficulty_scorer_name, dataset_fingerprint, tuple(kwargs_items))
 
 
 def get_difficulty_scorer(
@@ -30,7 +75,9 @@ def get_difficulty_scorer(
     trainer: Trainer,
 ) -> BaseDifficultyScorer:
     """
-    Returns a difficulty scorer based on the name.
+    Returns a difficulty scorer based on the name. Difficulty scorers are cached, so calling
+    this function again with the same name and kwargs, for a trainer with the same train
+    dataset, returns the same difficulty scorer (with the trainer and tokenizer reattached).
 
     Args:
         * difficulty_scorer_name (str): The name of the difficulty scorer
@@ -44,23 +91,35 @@ def get_difficulty_scorer(
     """
 
     if difficulty_scorer_name in DIFFICULTY_SCORER_REGISTRY:
-        difficulty_scorer = DIFFICULTY_SCORER_REGISTRY[difficulty_scorer_name](
-            **difficulty_scorer_kwargs,  # type: ignore
+        cache_key = _get_difficulty_scorer_cache_key(
+            difficulty_scorer_name, difficulty_scorer_kwargs, trainer
         )
 
+        if cache_key is not None and cache_key in _DIFFICULTY_SCORER_CACHE:
+            difficulty_scorer = _DIFFICULTY_SCORER_CACHE[cache_key]
+        else:
+            difficulty_scorer = DIFFICULTY_SCORER_REGISTRY[
+                difficulty_scorer_name
+            ](
+                **(difficulty_scorer_kwargs or {}),  # type: ignore
+            )
+            if cache_key is not None:
+                _DIFFICULTY_SCORER_CACHE[cache_key] = difficulty_scorer
+
         # If the difficulty scorer needs access to the trainer or the tokenizer, we pass it in
         # NOTE: The trainer is needed if the difficulty scorer uses the trainer itself to score
-        # the difficulty of the dataset.
+        # the difficulty of the dataset. Scorers only keep a weak reference to the trainer, so
+        # cached scorers don't keep old trainers (and their models and optimizers) alive.
 
-        if isinstance(difficulty_scorer, UsesTrainer):
-            difficulty_scorer.trainer = trainer
+        if difficulty_scorer_name in _USES_TRAINER:
+            difficulty_scorer.trainer = trainer  # type: ignore
 
-        if isinstance(difficulty_scorer, UsesTokenizer):
+        if difficulty_scorer_name in _USES_TOKENIZER:
             # NOTE: This assert statement should never fail, since we run a similar check on the
             # tokenizer before initializing the trainer. It is needed, however, to narrow the type
             # to pass type checking.
             assert isinstance(trainer.tokenizer, PreTrainedTokenizerFast)
-            difficulty_scorer.tokenizer = trainer.tokenizer
+            difficulty_scorer.tokenizer = trainer.tokenizer  # type: ignore
 
         return difficulty_scorer
 
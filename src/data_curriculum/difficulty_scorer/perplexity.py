@@ -6,7 +6,17 @@ of a dataset based on the perplexity of a n-gram model trained on the dataset.
 from __future__ import annotations
 
 import logging
-from typing import TYPE_CHECKING, Any, Generator, List, Sequence, Tuple, Union
+import weakref
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Generator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
 
 import torch
 
@@ -48,6 +58,12 @@ class PerplexityBaseClass(BaseDifficultyScorer):
 
     @tokenizer.setter
     def tokenizer(self, tokenizer: PreTrainedTokenizerFast):
+        # NOTE: the mask token id is looked up (and validated) once here, rather than on every
+        # batch that is scored by the trainer model
+        assert (
+            tokenizer.mask_token_id is not None
+        ), "The tokenizer must have a mask token to compute perplexity"
+        self.mask_idx: int = tokenizer.mask_token_id
         self._tokenizer = tokenizer
 
 
@@ -160,7 +176,10 @@ class NGramPerplexityScorer(PerplexityBaseClass):
 
         if global_stepnum == 0:
 
-            self._train_model(dataset)
+            # NOTE: Scorers are cached by get_difficulty_scorer for a given train dataset, so
+            # if the n-gram model has already been trained (on the same dataset) we reuse it
+            if not hasattr(self, "lm"):
+                self._train_model(dataset)
 
             assert hasattr(self, "lm") and hasattr(
                 self, "tokenized_text"
@@ -208,7 +227,13 @@ class NGramPerplexityScorer(PerplexityBaseClass):
 
 @register_difficulty_scorer("self_perplexity")
 class SelfPerplexityScorer(PerplexityBaseClass):
-    def __init__(self, n_gram: int, update: int, **kwargs):
+    def __init__(
+        self,
+        n_gram: int,
+        update: int,
+        num_samples: Optional[int] = None,
+        **kwargs,
+    ):
         """
         Initializes the n-gram perplexity scorer.
 
@@ -216,6 +241,9 @@ class SelfPerplexityScorer(PerplexityBaseClass):
             * n_gram (int): The n-gram to use for the initial n-gram model; setting to 0 to
                 randomly sample from the dataset
             * update (int): The number of steps to wait before updating the n-gram model
+            * num_samples (Optional[int]): If set, the pseudo-perplexity of each sample is
+                estimated by only masking out num_samples randomly sampled token positions,
+                rather than every token position
         """
 
         super().__init__(**kwargs)
@@ -230,6 +258,11 @@ class SelfPerplexityScorer(PerplexityBaseClass):
             self.ngram_model = NGramPerplexityScorer(n_gram)
 
         self.update = update
+
+        assert (
+            num_samples is None or num_samples > 0
+        ), "The number of sampled positions (num_samples) must be positive"
+        self.num_samples = num_samples
         self._trainer = None
         self._tokenizer = None
 
@@ -244,11 +277,13 @@ class SelfPerplexityScorer(PerplexityBaseClass):
 
     @property
     def trainer(self) -> Union[CustomTrainer, None]:
-        return self._trainer
+        return self._trainer() if self._trainer is not None else None
 
     @trainer.setter
     def trainer(self, trainer: CustomTrainer):
-        self._trainer = trainer
+        # NOTE: We only store a weak reference to the trainer, since difficulty scorers are
+        # cached by get_difficulty_scorer and should not keep the trainer alive
+        self._trainer = weakref.ref(trainer)
 
     def score_difficulty(
         self,
@@ -311,7 +346,7 @@ class SelfPerplexityScorer(PerplexityBaseClass):
                 data_cl_logger.info(
                     f"Recalculating sample weights using model at step {global_stepnum}"
                 )
-                self._difficulty_scores: Sequence[float] = []
+                batch_perplexities: List[torch.Tensor] = []
 
                 with torch.no_grad():
                     data_cl_logger.info(
@@ -333,10 +368,19 @@ class SelfPerplexityScorer(PerplexityBaseClass):
 
                     for batch in tqdm(inference_dataloader):
                         batch_perplexity = compute_trainer_perplexity(
-                            batch, self.tokenizer, self.trainer
+                            batch,
+                            self.mask_idx,
+                            self.trainer,
+                            num_samples=self.num_samples,
                         )
 
-                        self._difficulty_scores.extend(batch_perplexity)
+                        batch_perplexities.append(batch_perplexity)
+
+                # NOTE: The perplexities are only transferred off the device once all batches have
+                # been scored, to avoid synchronizing with the device on every batch
+                self._difficulty_scores: Sequence[float] = (
+                    torch.cat(batch_perplexities).cpu().tolist()
+                )
 
         assert hasattr(
             self, "_difficulty_scores"
@@ -3,6 +3,7 @@
 # typing imports
 from typing import Any, Dict
 
+import torch
 from torch.nn.parallel import DistributedDataParallel
 from transformers import (
     AdamW,
@@ -23,6 +24,13 @@ class _DataCollatorForLanguageModeling(DataCollatorForLanguageModeling):
         super().__init__(*args, **kwargs)
         self.unmask_probability = unmask_probability
 
+        # NOTE: Used to determine the special tokens of a batch if the batch does not come with a
+        # special tokens mask, instead of checking each sequence in python
+        self._special_token_ids = torch.tensor(self.tokenizer.all_special_ids)
+        self._mask_token_id = self.tokenizer.convert_tokens_to_ids(
+            self.tokenizer.mask_token
+        )
+
     def torch_call(self, *args):
         """
         Prepares data for the masked language modeling task.
@@ -48,21 +56,11 @@ class _DataCollatorForLanguageModeling(DataCollatorForLanguageModeling):
         """
         Prepare masked tokens inputs/labels for masked language modeling: 80% MASK, 10% random, 10% original.
         """
-        import torch
-
         labels = inputs.clone()
         # We sample a few tokens in each sequence for MLM training (with probability `self.mlm_probability`)
         probability_matrix = torch.full(labels.shape, self.mlm_probability)
         if special_tokens_mask is None:
-            special_tokens_mask = [
-                self.tokenizer.get_special_tokens_mask(
-                    val, already_has_special_tokens=True
-                )
-                for val in labels.tolist()
-            ]
-            special_tokens_mask = torch.tensor(
-                special_tokens_mask, dtype=torch.bool
-            )
+            special_tokens_mask = torch.isin(labels, self._special_token_ids)
         else:
             special_tokens_mask = special_tokens_mask.bool()
 
@@ -74,29 +72,26 @@ class _DataCollatorForLanguageModeling(DataCollatorForLanguageModeling):
         # Here we do 90-self.unmask_probability mask, 10% random, self.unmask_probability original
         keep_mask_prob = 0.9 - self.unmask_probability
         random_prob = 0.1
-        remainder_prob = random_prob / (self.unmask_probability + random_prob)
 
-        # keep_mask_prob% of the time, we replace masked input tokens with tokenizer.mask_token ([MASK])
-        indices_replaced = (
-            torch.bernoulli(torch.full(labels.shape, keep_mask_prob)).bool()
-            & masked_indices
-        )
-        inputs[indices_replaced] = self.tokenizer.convert_tokens_to_ids(
-            self.tokenizer.mask_token
-        )
-
-        # 10% of the time, we replace masked input tokens with random word. If self.unmask_probability is 0, this is all remaining masked tokens
-        indices_random = (
-            torch.bernoulli(torch.full(labels.shape, remainder_prob)).bool()
-            & masked_indices
-            & ~indices_replaced
-        )
+        # A single uniform draw decides what happens to each masked token: keep_mask_prob% of
+        # the time we replace it with tokenizer.mask_token ([MASK]), random_prob% of the time
+        # with a random word, and the rest of the time (self.unmask_probability) we keep the
+        # masked input token unchanged.
+        replacement_draw = torch.rand(labels.shape)
         random_words = torch.randint(
             len(self.tokenizer), labels.shape, dtype=torch.long
         )
-        inputs[indices_random] = random_words[indices_random]
+        replaced_inputs = torch.where(
+            replacement_draw < keep_mask_prob,
+            self._mask_token_id,
+            torch.where(
+                replacement_draw < keep_mask_prob + random_prob,
+                random_words,
+                inputs,
+            ),
+        )
+        inputs = torch.where(masked_indices, replaced_inputs, inputs)
 
-        # The rest of the time (self.unmask_probability) we keep the masked input tokens unchanged.
         return inputs, labels
 
 
@@ -679,14 +679,14 @@ class CustomTrainer(Trainer):
 
                 for batch in tqdm(inference_dataloader):
                     batch_perplexity = compute_trainer_perplexity(
-                        batch, self.tokenizer, self
+                        batch, mask_idx, self
                     )
 
-                    perplexities.extend(batch_perplexity)
+                    perplexities.append(batch_perplexity)
 
-            tensor_perplexities = torch.tensor(
-                perplexities, device=self.args.device
-            )
+            # NOTE: The perplexities of all batches are kept on the device, and only
+            # transferred once all batches have been scored
+            tensor_perplexities = torch.cat(perplexities)
             perplexity_mean = torch.mean(tensor_perplexities)
             perplexity_std = torch.std(tensor_perplexities)
 
@@ -708,12 +708,12 @@ class CustomTrainer(Trainer):
                 dist.all_gather(gathered_perplexity_std, perplexity_std)
 
             # if main process
-            metrics[f"{metric_key_prefix}_perplexity_mean"] = torch.mean(
-                torch.tensor(perplexities)
-            ).item()
-            metrics[f"{metric_key_prefix}_perplexity_std"] = torch.std(
-                torch.tensor(perplexities)
-            ).item()
+            metrics[
+                f"{metric_key_prefix}_perplexity_mean"
+            ] = perplexity_mean.item()
+            metrics[
+                f"{metric_key_prefix}_perplexity_std"
+            ] = perplexity_std.item()
 
         self.save_model(self.args.output_dir, _internal_call=True)
         # if world size > 1, then we need to synchronize the model across all processes
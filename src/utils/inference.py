@@ -4,17 +4,24 @@ Utility functions for running model inference.
 
 from __future__ import annotations
 
+import logging
+from contextlib import nullcontext
+
 # typing imports
-from typing import TYPE_CHECKING, Dict, List
+from typing import TYPE_CHECKING, Callable, Dict, Optional
 
 import torch
-from datasets import Dataset
-from transformers import PreTrainedTokenizerFast
+from datasets import Dataset, Sequence, Value
+from torch.nn import Module
+from torch.nn.functional import log_softmax
 
 if TYPE_CHECKING:
     # avoid circular imports
     from src.trainer import CustomTrainer
 
+# A logger for this file
+logger = logging.getLogger(__name__)
+
 
 def prepare_dataset_for_ppl_inference(
     trainer: CustomTrainer,
@@ -34,91 +41,273 @@ def prepare_dataset_for_ppl_inference(
     assert "special_tokens_mask" in ignore_columns
     ignore_columns.remove("special_tokens_mask")
 
-    return dataset.remove_columns(ignore_columns)
+    dataset = dataset.remove_columns(ignore_columns)
+
+    # NOTE: storing the special tokens mask as booleans means the collated batches can be used
+    # directly as a mask, without a conversion on every batch. The training and evaluation
+    # datasets are already cast when they are preprocessed, so this is only a fallback.
+    if dataset.features["special_tokens_mask"].feature.dtype != "bool":
+        dataset = dataset.cast_column(
+            "special_tokens_mask", Sequence(Value("bool"))
+        )
+
+    return dataset
+
+
+def _pll_step(
+    model: Module,
+    task_head: Module,
+    input_ids: torch.Tensor,
+    positions: torch.Tensor,
+    mask_idx: int,
+    use_bf16_autocast: bool,
+) -> torch.Tensor:
+    """
+    Computes the loss of the masked language model at the given positions of input_ids, where
+    each position is masked out in a separate copy of the input ids.
+
+    Args:
+        * model: the base model that is used for computing the hidden states
+        * task_head: the mlm task head that maps hidden states to logits over the vocabulary
+        * input_ids: a (batch, seq len) tensor of input ids
+        * positions: a (batch, #masked positions) tensor of the token positions to mask out
+        * mask_idx: the id of the mask token
+        * use_bf16_autocast: whether to run the forward pass under bfloat16 autocast
+    Returns:
+        * loss: a (batch, #masked positions) tensor of the negative log likelihood of the
+            original token at each masked position
+    """
+
+    batch_size, seq_len = input_ids.shape
+    num_positions = positions.size(1)
+
+    # (Batch, #masked positions, seq len); expand is a view so only the clone allocates
+    # NOTE: the vocabulary easily fits in int32 (which the embedding lookup accepts), so we use
+    # it to halve the size of the masked input copies
+    masked_input = (
+        input_ids.to(torch.int32)
+        .unsqueeze(1)
+        .expand(-1, num_positions, -1)
+        .clone()
+    )
+
+    # For each batch, setting the i-th row to the MASK token id at the i-th masked position
+    masked_input.scatter_(2, positions.unsqueeze(-1), mask_idx)
+
+    # NOTE: autocast is only ever enabled on GPUs; we don't enter an autocast context otherwise,
+    # since older versions of torch raise for device types other than cuda and cpu
+    autocast_context = (
+        torch.autocast(device_type="cuda", dtype=torch.bfloat16)
+        if use_bf16_autocast
+        else nullcontext()
+    )
+
+    with autocast_context:
+        # combining the masked positions dimension (2nd dim) with the batch dim (1st dim)
+        # NOTE this gives an effective batch size = batch_size * num_positions
+        base_model_hidden_states = model(
+            input_ids=masked_input.view(-1, seq_len)
+        )[0]
+
+        # Each row of the effective batch only has a single masked token, so we only pass
+        # the hidden states at the masked positions (batch, num_positions, hidden size)
+        # through the task head, rather than computing logits for every token of every row.
+        # NOTE: gathering along the sequence dimension avoids building index ranges over the
+        # batch and the masked positions on every call
+        hidden_size = base_model_hidden_states.size(-1)
+        masked_hidden_states = base_model_hidden_states.gather(
+            1, positions.reshape(-1, 1, 1).expand(-1, 1, hidden_size)
+        ).view(batch_size, num_positions, hidden_size)
 
+        logits = task_head(masked_hidden_states)
 
+    # log softmax over the vocabulary is computed in float32 for numerical stability
+    log_probs = log_softmax(logits.float(), dim=-1)
+
+    # negative log likelihood of the original token at each masked position
+    return -log_probs.gather(
+        -1, input_ids.gather(1, positions).unsqueeze(-1)
+    ).squeeze(-1)
+
+
+# NOTE: Compiling the masking, forward pass and loss computation lets the mask construction
+# and the gather of the loss be fused with the model's kernels; compute_trainer_perplexity
+# keeps the shapes passed in static, so this is only compiled once per batch size. The
+# compiled function is created on the first call on a GPU, and is replaced by the eager
+# _pll_step if torch.compile is not available (torch < 2.0) or compilation fails.
+_compiled_pll_step: Optional[Callable[..., torch.Tensor]] = None
+
+
+def _compiled_pll_step_with_fallback(*args) -> torch.Tensor:
+    """
+    Calls the compiled version of _pll_step, compiling it on the first call; falls back to
+    (and from then on only uses) the eager _pll_step if compilation is not possible. Only
+    errors raised by the compiler trigger the fallback, all other errors are propagated.
+    """
+    global _compiled_pll_step
+
+    if _compiled_pll_step is None:
+        try:
+            # NOTE: raises an AttributeError on torch < 2.0, and a RuntimeError if dynamo does
+            # not support the python version
+            _compiled_pll_step = torch.compile(
+                _pll_step, mode="reduce-overhead", dynamic=False
+            )
+        except (AttributeError, RuntimeError) as e:
+            logger.warning(
+                f"Perplexity computation can not be compiled ({e}), computing perplexity eagerly"
+            )
+            _compiled_pll_step = _pll_step
+
+    if _compiled_pll_step is _pll_step:
+        return _pll_step(*args)
+
+    # NOTE: torch._dynamo only exists (and is imported by torch.compile) on torch >= 2.0
+    from torch._dynamo.exc import TorchDynamoException
+
+    try:
+        return _compiled_pll_step(*args)
+    except TorchDynamoException as e:
+        # NOTE: e.g. triton is not installed or the GPU is not supported by the compiler; the
+        # compiler may be invoked again on later calls (e.g. for a new batch size), so this can
+        # happen after the first call as well
+        logger.warning(
+            f"Compiling the perplexity computation failed ({e}), computing perplexity eagerly"
+        )
+        _compiled_pll_step = _pll_step
+
+    return _pll_step(*args)
+
+
+@torch.inference_mode()
 def compute_trainer_perplexity(
     batch: Dict[str, torch.Tensor],
-    tokenizer: PreTrainedTokenizerFast,
+    mask_idx: int,
     trainer: CustomTrainer,
-) -> List[float]:
+    chunk_size: int = 32,
+    num_samples: Optional[int] = None,
+) -> torch.Tensor:
     """
 
     A helper fucntion for computing the perplexity of a batch of data. Assumes that the data
     has been tokenized and batched using the same tokenizer that was used for training the model.
+    The computation runs in inference mode, so the returned tensor can not be used in autograd.
 
     Args:
         * batch: a batch of data that should contain a key "input_ids" as well as
             "special_tokens_mask" (by default this is returned by the tokenizer we uses).
-        * tokenizer: a tokenizer object that was used for tokenizing the input ids, we use this
-            only to determine the mask token id.
+        * mask_idx: the id of the mask token of the tokenizer that was used for tokenizing the
+            input ids; callers are expected to have checked that the tokenizer has a mask token.
         * trainer: a trainer object that was used for training the model
+        * chunk_size: the number of token positions that are masked out (and passed through
+            the model) at once; bounds the effective batch size to batch_size * chunk_size
+        * num_samples: if set, instead of masking out every token position, we only mask out
+            num_samples randomly sampled (non-special) positions of each sequence and use the
+            mean loss over these as an estimate of the pseudo-perplexity of the sequence
     Returns:
-        * perplexity (float): The perplexity of the n-gram
+        * batch_perplexity (torch.Tensor): A tensor of length batch_size storing the perplexity
+            of each sample; the tensor is left on the trainer device so that callers can
+            collect the perplexities of all batches before transferring them at once
 
     """
 
-    mask_idx = tokenizer.mask_token_id
-
-    assert (
-        mask_idx is not None
-    ), "The tokenizer must have a mask token and a pad token"
-
-    input_ids = batch["input_ids"]
+    # NOTE: the batches are collated into pinned memory by the inference dataloaders, so the
+    # transfers to the device can be done asynchronously
+    input_ids = batch["input_ids"].to(trainer.args.device, non_blocking=True)
 
     batch_size = input_ids.size(0)
     seq_len = input_ids.size(1)
 
-    # (Batch, #repetitions dimension, seq len)
-    input_ids = input_ids.unsqueeze(1).to(trainer.args.device)
-
-    repeat_ids = input_ids.repeat([1, seq_len, 1])
-
-    mask = (
-        torch.ones(input_ids.size(-1), device=trainer.args.device).diag(0)
-    ).repeat([batch_size, 1, 1])
-
-    # Setting the diagonal for each batch to MASK token id (0)
-    masked_input = repeat_ids.masked_fill(mask == 1, mask_idx)
-
-    # For each batch, set the labels to be the original input ids (all others to ignore_index=-100)
-    labels = repeat_ids.masked_fill(masked_input != mask_idx, -100)
-
-    # For each batch, if the label is a special token, set it to -100 (ignore_index)
-    special_tokens_mask = (
-        batch["special_tokens_mask"].unsqueeze(1).to(trainer.args.device)
+    special_tokens_mask = batch["special_tokens_mask"].to(
+        trainer.args.device, dtype=torch.bool, non_blocking=True
     )
-    labels = labels.masked_fill(special_tokens_mask == 1, -100)
-
-    # combining the repeated input ids dimension (2nd dim) with the batch dim (1st dim)
-    # NOTE this gives an effective batch size = batch_size * seq_len
-    masked_input = masked_input.view(-1, seq_len)
-    labels = labels.view(-1, seq_len)
 
     # NOTE: The 'mlm' unit is always in the objective curriculum
     # (this is checked by ObjectiveCurriculum.__init__)
-    loss = trainer.objective_curriculum.units["mlm"].compute_loss(
-        trainer.model,
-        {},  # We don't provide a standard batch of data
-        override_input_ids=masked_input,
-        override_lables=labels,
-        loss_kwargs={
-            "reduction": "none",
-        },
-    )
+    mlm_task_head = trainer.objective_curriculum.units["mlm"].task_head
+
+    if num_samples is None:
+        # (Batch, max #non-special tokens): the positions of the non-special tokens of each
+        # sequence (in order), each of which is masked out once. Special tokens are never
+        # scored, so we don't spend forward passes on masking them out; shorter sequences are
+        # padded with the positions of their special tokens, whose loss is ignored
+        num_non_special_tokens = int((~special_tokens_mask).sum(dim=-1).max())
+        positions = torch.sort(
+            special_tokens_mask.to(torch.uint8), dim=-1, stable=True
+        ).indices[:, :num_non_special_tokens]
+
+        chunk_size = min(chunk_size, seq_len)
+    else:
+        # (Batch, num_samples): positions sampled uniformly (with replacement) from the
+        # non-special tokens of each sequence, so the mean loss over the sampled positions is
+        # an unbiased estimate of the mean loss over all non-special tokens.
+        # NOTE: sequences that only contain special tokens are sampled uniformly; their loss is
+        # ignored regardless
+        sample_weights = (~special_tokens_mask).float()
+        sample_weights[sample_weights.sum(dim=-1) == 0] = 1.0
+        positions = torch.multinomial(
+            sample_weights, num_samples, replacement=True
+        )
+
+        chunk_size = min(chunk_size, num_samples)
+
+    num_masked_positions = positions.size(1)
+
+    # NOTE: So that every chunk has the same (static) shape, we pad the positions to a multiple
+    # of the chunk size by repeating the last position; the padding is never scored
+    num_padding = -num_masked_positions % chunk_size
+    if num_padding > 0:
+        positions = torch.cat(
+            [positions, positions[:, -1:].expand(-1, num_padding)], dim=1
+        )
+
+    # If the token at a masked position is a special token, we ignore its loss
+    scored_positions = ~special_tokens_mask.gather(1, positions)
+    scored_positions[:, num_masked_positions:] = False
+
+    # loss for each masked position in each batch, filled in one chunk of positions at a time
+    loss = torch.zeros(positions.shape, device=trainer.args.device)
+
+    # NOTE: The forward pass is inference-only, so on GPUs that support it we run the model in
+    # bfloat16 (the losses are still computed and reduced in float32). We also only compile the
+    # computation on GPUs, where the fused kernels are generated with triton
+    use_cuda = trainer.args.device.type == "cuda"
+    use_bf16_autocast = use_cuda and torch.cuda.is_bf16_supported()
+    pll_step = _compiled_pll_step_with_fallback if use_cuda else _pll_step
+
+    # NOTE: The model and the task head are put in eval mode (disabling dropout) while scoring
+    # and are restored to their previous mode afterwards, since this is called during training
+    model_was_training = trainer.model.training
+    task_head_was_training = mlm_task_head.training
+    trainer.model.eval()
+    mlm_task_head.eval()
+
+    try:
+        for start in range(0, positions.size(1), chunk_size):
+            chunk_positions = positions[:, start : start + chunk_size]
+
+            chunk_loss = pll_step(
+                trainer.model,
+                mlm_task_head,
+                input_ids,
+                chunk_positions,
+                mask_idx,
+                use_bf16_autocast,
+            )
+
+            loss[:, start : start + chunk_size] = chunk_loss.masked_fill(
+                ~scored_positions[:, start : start + chunk_size], 0.0
+            )
+    finally:
+        trainer.model.train(model_was_training)
+        mlm_task_head.train(task_head_was_training)
 
-    # loss is a tensor (batch * seq_len, seq_len), where in the second dimension only at most one
-    # token should be non-zero (the masked token). We sum over the second dimension to get the
-    # loss for each token in each batch
-    loss = loss.sum(dim=-1)
-
-    # Now loss is a vector of (batch * seq_len) length, we reshape it to (batch, seq_len)
-    loss = loss.view(batch_size, seq_len)
     # we can now sum over the second dimension to get the loss for each sample
     summed_loss = loss.sum(dim=-1)
 
-    # Now we divide by the number of non-masked tokens in each batch to get avg loss
-    non_masked_tokens = torch.sum(special_tokens_mask == 0, dim=-1).squeeze()
+    # Now we divide by the number of scored (non-special) masked positions in each batch to
+    # get avg loss
+    non_masked_tokens = torch.sum(scored_positions, dim=-1)
 
     # Avoiding division by zero
     non_masked_tokens[non_masked_tokens == 0] = 1
@@ -128,7 +317,4 @@ def compute_trainer_perplexity(
     # batch perplexity is a vector of length batch_size
     batch_perplexity = torch.exp(mean_loss)
 
-    # converting batch perplexity to a list of floats
-    batch_perplexity = batch_perplexity.cpu().tolist()
-
     return batch_perplexity
@@ -8,7 +8,7 @@ import hydra
 import torch
 
 # training pipeline imports
-from datasets import DatasetDict, load_dataset
+from datasets import DatasetDict, Sequence, Value, load_dataset
 from hydra.core.config_store import ConfigStore
 from omegaconf import OmegaConf
 from torch.distributed.elastic.multiprocessing.errors import record
@@ -110,6 +110,12 @@ def main(cfg: BabyLMConfig):
         remove_columns=dataset["train"].column_names,
     )
 
+    # NOTE: We store the special tokens mask as booleans once, here, so that it can be used as a
+    # mask directly whenever the data is scored (e.g. by the perplexity difficulty scorers)
+    train_dataset = train_dataset.cast_column(
+        "special_tokens_mask", Sequence(Value("bool"))
+    )
+
     if cfg.experiment.dry_run:
         logger.info(
             f"Running in dry run mode -- subsampling dataset by {DRY_RUN_SUBSAMPLE_FACTOR}x"
@@ -124,6 +130,9 @@ def main(cfg: BabyLMConfig):
         num_proc=64,
         remove_columns=dataset["validation"].column_names,
     )
+    eval_dataset = eval_dataset.cast_column(
+        "special_tokens_mask", Sequence(Value("bool"))
+    )
 
     # Setting up wandb
     if cfg.experiment.offline_run: